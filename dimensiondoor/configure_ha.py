@@ -8,16 +8,32 @@ with trusted_proxies so the tunnel add-on can proxy traffic correctly.
 Runs on every add-on start to ensure config is always correct.
 """
 
-import json
+import contextlib
+import http.client
 import logging
 import os
+import re
 import shutil
-import urllib.request
-import urllib.error
+import socket
+import stat
+import threading
 from datetime import datetime
 
 import yaml
 
+# orjson is optional; both it and the stdlib json accept bytes directly
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# Prefer the libyaml-backed loader/dumper; fall back to pure Python if
+# PyYAML was built without libyaml
+try:
+    from yaml import CSafeLoader as _BaseLoader, CSafeDumper as _BaseDumper
+except ImportError:
+    from yaml import SafeLoader as _BaseLoader, SafeDumper as _BaseDumper
+
 logger = logging.getLogger("dimensiondoor.config")
 
 # Path to HA configuration.yaml (mapped via config:rw in add-on config)
@@ -31,6 +47,28 @@ REQUIRED_PROXIES = [
     "::1",              # loopback IPv6
 ]
 
+# Supervisor config check timeouts (seconds). A hung supervisor shouldn't
+# block add-on startup for long: connecting gets CHECK_CONNECT_TIMEOUT and the
+# whole exchange, connect included, is cut off after CHECK_TOTAL_TIMEOUT.
+CHECK_CONNECT_TIMEOUT = 5
+CHECK_TOTAL_TIMEOUT = 15
+
+# Line patterns that must all match inside the http: block for the config to
+# already be set up. Commented-out lines and substrings of other values don't count.
+_HTTP_SECTION_RE = re.compile(rb"^http:[ \t]*(#.*)?$", re.MULTILINE)
+_TOP_LEVEL_LINE_RE = re.compile(rb"^[^\s#]", re.MULTILINE)
+_FAST_PATH_PATTERNS = [
+    re.compile(rb"^\s+use_x_forwarded_for:\s*true\s*(#.*)?$", re.MULTILINE),
+] + [
+    re.compile(rb"^\s*-\s*['\"]?" + re.escape(p.encode()) + rb"['\"]?\s*(#.*)?$", re.MULTILINE)
+    for p in REQUIRED_PROXIES
+]
+
+# Line patterns used to patch trusted_proxies in place
+_HTTP_KEY_LINE_RE = re.compile(r"^http:\s*(#.*)?$")
+_TRUSTED_PROXIES_LINE_RE = re.compile(r"^(\s+)trusted_proxies:\s*(#.*)?$")
+_LIST_ITEM_LINE_RE = re.compile(r"^(\s*)-(\s|$)")
+
 
 # --- Custom YAML constructors for HA's !include directives ---
 # Without these, PyYAML would crash on HA's custom tags
@@ -42,10 +80,9 @@ class HAInclude:
         self.value = value
 
 
-def _ha_include_constructor(loader, tag, node):
-    """Handle all !include* YAML tags from HA."""
-    value = loader.construct_scalar(node)
-    return HAInclude(tag, value)
+def _ha_include_constructor(loader, node):
+    """Handle all !include* YAML tags from HA (the tag is taken from the node)."""
+    return HAInclude(node.tag, loader.construct_scalar(node))
 
 
 def _ha_include_representer(dumper, data):
@@ -65,37 +102,103 @@ _HA_TAGS = [
 ]
 
 
-class HALoader(yaml.SafeLoader):
+class HALoader(_BaseLoader):
     pass
 
 
-class HADumper(yaml.SafeDumper):
+class HADumper(_BaseDumper):
     pass
 
 
 for tag in _HA_TAGS:
-    HALoader.add_constructor(
-        tag, lambda loader, node, t=tag: _ha_include_constructor(loader, t, node)
-    )
-    HADumper.add_representer(
-        HAInclude, _ha_include_representer
-    )
+    HALoader.add_constructor(tag, _ha_include_constructor)
+
+HADumper.add_representer(HAInclude, _ha_include_representer)
 
 # Also handle any unknown tags gracefully
 HALoader.add_multi_constructor(
-    "!", lambda loader, tag, node: _ha_include_constructor(loader, tag, node)
+    "!", lambda loader, tag_suffix, node: _ha_include_constructor(loader, node)
 )
 
 
 def _backup_config(config_path: str) -> str:
-    """Create a timestamped backup of configuration.yaml."""
+    """
+    Create a timestamped backup of configuration.yaml.
+
+    Hardlinks when possible: every write goes through _write_config, which
+    swaps in a new inode, so the linked backup is never modified.
+    """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_path = f"{config_path}.dimensiondoor_backup_{timestamp}"
-    shutil.copy2(config_path, backup_path)
+    # os.link doesn't follow symlinks; link the real file, not the symlink
+    real_path = os.path.realpath(config_path)
+    try:
+        os.link(real_path, backup_path)
+    except OSError:
+        shutil.copyfile(real_path, backup_path)
     logger.info(f"Configuration backup created: {backup_path}")
     return backup_path
 
 
+def _is_already_configured(config_path: str) -> bool:
+    """
+    Cheap textual pre-check for an already patched configuration.yaml.
+
+    Lets the common restart case skip the full YAML parse. A miss just
+    falls through to the real load/mutate/dump path.
+    """
+    with open(config_path, "rb") as f:
+        blob = f.read()
+    http = _HTTP_SECTION_RE.search(blob)
+    if not http:
+        return False
+    # The http: block runs until the next top-level key
+    end = _TOP_LEVEL_LINE_RE.search(blob, http.end() + 1)
+    block = blob[http.end():end.start() if end else len(blob)]
+    return all(pattern.search(block) for pattern in _FAST_PATH_PATTERNS)
+
+
+def _write_config(config_path: str, data: bytes):
+    """
+    Atomically replace config_path with data: write a temp file next to it in
+    one go, fsync, then rename over the original. A crash mid-write leaves
+    the original file intact.
+
+    A symlinked config_path is resolved first so the symlink stays in place
+    and its target is what gets replaced.
+    """
+    real_path = os.path.realpath(config_path)
+    tmp_path = f"{real_path}.dimensiondoor_tmp"
+    try:
+        mode = stat.S_IMODE(os.stat(real_path).st_mode)
+    except OSError:
+        mode = 0o644
+
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            os.fchmod(fd, mode)  # not subject to umask
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+    # Persist the rename itself
+    with contextlib.suppress(OSError):
+        dir_fd = os.open(os.path.dirname(real_path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
 def _load_config(config_path: str) -> dict:
     """Load HA configuration.yaml with custom tag support."""
     with open(config_path, "r", encoding="utf-8") as f:
@@ -105,15 +208,101 @@ def _load_config(config_path: str) -> dict:
 
 def _save_config(config_path: str, config: dict):
     """Save configuration.yaml preserving HA custom tags."""
-    with open(config_path, "w", encoding="utf-8") as f:
-        yaml.dump(
-            config,
-            f,
-            Dumper=HADumper,
-            default_flow_style=False,
-            allow_unicode=True,
-            sort_keys=False,
-        )
+    text = yaml.dump(
+        config,
+        Dumper=HADumper,
+        default_flow_style=False,
+        allow_unicode=True,
+        sort_keys=False,
+    )
+    _write_config(config_path, text.encode("utf-8"))
+
+
+def _append_trusted_proxies(config_path: str, proxies: list) -> bool:
+    """
+    Append entries to an existing block-style http: trusted_proxies list by
+    editing the text directly, keeping the user's comments and formatting.
+
+    Returns False (without touching the file) if the list can't be located
+    unambiguously; the caller then falls back to a full YAML dump.
+    """
+    with open(config_path, "r", encoding="utf-8", newline="") as f:
+        text = f.read()
+    lines = text.splitlines(keepends=True)
+
+    def content(line):
+        return line.rstrip("\r\n")
+
+    def is_blank_or_comment(line):
+        stripped = line.strip()
+        return not stripped or stripped.startswith("#")
+
+    http_idx = next(
+        (i for i, line in enumerate(lines) if _HTTP_KEY_LINE_RE.match(content(line))), None
+    )
+    if http_idx is None:
+        return False
+
+    # Find trusted_proxies: within the http: block (ends at the next top-level line)
+    key_idx = None
+    for i in range(http_idx + 1, len(lines)):
+        line = content(lines[i])
+        if is_blank_or_comment(line):
+            continue
+        if not line[0].isspace():
+            break
+        if _TRUSTED_PROXIES_LINE_RE.match(line):
+            key_idx = i
+            break
+    if key_idx is None:
+        return False
+    key_indent = len(_TRUSTED_PROXIES_LINE_RE.match(content(lines[key_idx])).group(1))
+
+    # Find the last item of the list directly below it
+    item_indent = None
+    last_item_idx = None
+    for i in range(key_idx + 1, len(lines)):
+        line = content(lines[i])
+        if is_blank_or_comment(line):
+            continue
+        m = _LIST_ITEM_LINE_RE.match(line)
+        indent = len(line) - len(line.lstrip())
+        if m and item_indent is None and len(m.group(1)) >= key_indent:
+            item_indent = len(m.group(1))
+        elif item_indent is None or indent < item_indent or (indent == item_indent and not m):
+            break
+        if indent == item_indent:
+            last_item_idx = i
+    if last_item_idx is None:
+        return False
+
+    # Items may span several lines; insert after the last line belonging to the list
+    insert_idx = last_item_idx + 1
+    while insert_idx < len(lines):
+        line = content(lines[insert_idx])
+        if is_blank_or_comment(line) or len(line) - len(line.lstrip()) <= item_indent:
+            break
+        insert_idx += 1
+
+    newline = "\r\n" if lines[last_item_idx].endswith("\r\n") else "\n"
+    prev = lines[insert_idx - 1]
+    if not prev.endswith(("\n", "\r")):
+        lines[insert_idx - 1] = prev + newline
+    indent = " " * item_indent
+    lines[insert_idx:insert_idx] = [f"{indent}- {p}{newline}" for p in proxies]
+    patched = "".join(lines)
+
+    # Make sure the edit produced what we expect before writing it out
+    try:
+        config = yaml.load(patched, Loader=HALoader)
+        existing = {str(p) for p in config["http"]["trusted_proxies"]}
+    except Exception:
+        return False
+    if not all(p in existing for p in proxies):
+        return False
+
+    _write_config(config_path, patched.encode("utf-8"))
+    return True
 
 
 def _check_ha_config() -> tuple[bool, str]:
@@ -127,37 +316,61 @@ def _check_ha_config() -> tuple[bool, str]:
         logger.warning("SUPERVISOR_TOKEN not available - skipping config validation")
         return True, "skipped (no supervisor token)"
 
-    url = "http://supervisor/core/api/config/core/check_config"
     headers = {
         "Authorization": f"Bearer {supervisor_token}",
         "Content-Type": "application/json",
     }
 
+    conn = http.client.HTTPConnection("supervisor", timeout=CHECK_CONNECT_TIMEOUT)
+    # Socket timeouts only bound each individual read, so a supervisor trickling
+    # bytes could stall us forever; shut the socket down at the overall deadline.
+    timed_out = threading.Event()
+
+    def abort():
+        timed_out.set()
+        if conn.sock is not None:
+            with contextlib.suppress(OSError):
+                conn.sock.shutdown(socket.SHUT_RDWR)
+
+    deadline = threading.Timer(CHECK_TOTAL_TIMEOUT, abort)
+    deadline.daemon = True
+    deadline.start()
     try:
-        req = urllib.request.Request(url, method="POST", headers=headers)
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            data = json.loads(resp.read().decode())
-            result = data.get("result", "unknown")
-            errors = data.get("errors")
-
-            if result == "valid" or (errors is None and result != "invalid"):
-                return True, "Configuration is valid"
-            else:
-                return False, f"Configuration invalid: {errors}"
-    except urllib.error.HTTPError as e:
-        body = e.read().decode() if e.fp else ""
-        logger.warning(f"Config check HTTP error {e.code}: {body}")
-        # Don't treat API errors as config failures
-        return True, f"check unavailable (HTTP {e.code})"
+        conn.connect()
+        conn.sock.settimeout(CHECK_TOTAL_TIMEOUT)
+        conn.request("POST", "/core/api/config/core/check_config", headers=headers)
+        resp = conn.getresponse()
+        raw = resp.read()
+
+        if resp.status >= 400:
+            logger.warning(f"Config check HTTP error {resp.status}: {raw.decode(errors='replace')}")
+            # Don't treat API errors as config failures
+            return True, f"check unavailable (HTTP {resp.status})"
+
+        data = _json_loads(raw)
+        result = data.get("result", "unknown")
+        errors = data.get("errors")
+
+        if result == "valid" or (errors is None and result != "invalid"):
+            return True, "Configuration is valid"
+        else:
+            return False, f"Configuration invalid: {errors}"
     except Exception as e:
+        if timed_out.is_set():
+            e = f"timed out after {CHECK_TOTAL_TIMEOUT}s"
         logger.warning(f"Config check failed: {e}")
         # If we can't reach the API, don't block - assume OK
         return True, f"check unavailable ({e})"
+    finally:
+        deadline.cancel()
+        conn.close()
 
 
 def _restore_backup(config_path: str, backup_path: str):
     """Restore configuration.yaml from backup."""
-    shutil.copy2(backup_path, config_path)
+    # Copy rather than rename so the backup stays around for the user
+    with open(backup_path, "rb") as f:
+        _write_config(config_path, f.read())
     logger.info(f"Restored configuration.yaml from backup: {backup_path}")
 
 
@@ -175,6 +388,13 @@ def ensure_http_config(config_path: str = HA_CONFIG_PATH) -> bool:
         logger.warning(f"Configuration file not found: {config_path}")
         return False
 
+    try:
+        if _is_already_configured(config_path):
+            logger.info("configuration.yaml already has the required http: trusted_proxies config.")
+            return False
+    except OSError as e:
+        logger.warning(f"Fast config pre-check failed: {e}")
+
     try:
         config = _load_config(config_path)
     except Exception as e:
@@ -183,11 +403,14 @@ def ensure_http_config(config_path: str = HA_CONFIG_PATH) -> bool:
         return False
 
     changes_made = False
+    # Anything beyond appending to an existing trusted_proxies list needs a full dump
+    needs_dump = False
 
     # Ensure http: section exists
     if "http" not in config or config["http"] is None:
         config["http"] = {}
         changes_made = True
+        needs_dump = True
         logger.info("Added http: section to configuration.yaml")
 
     http_config = config["http"]
@@ -196,19 +419,22 @@ def ensure_http_config(config_path: str = HA_CONFIG_PATH) -> bool:
     if not http_config.get("use_x_forwarded_for"):
         http_config["use_x_forwarded_for"] = True
         changes_made = True
+        needs_dump = True
         logger.info("Set use_x_forwarded_for: true")
 
     # Ensure trusted_proxies exists and contains our required entries
     if "trusted_proxies" not in http_config or http_config["trusted_proxies"] is None:
         http_config["trusted_proxies"] = []
         changes_made = True
+        needs_dump = True
 
-    existing_proxies = [str(p) for p in http_config["trusted_proxies"]]
+    existing_proxies = {str(p) for p in http_config["trusted_proxies"]}
+    added_proxies = [p for p in REQUIRED_PROXIES if p not in existing_proxies]
 
-    for proxy in REQUIRED_PROXIES:
-        if proxy not in existing_proxies:
-            http_config["trusted_proxies"].append(proxy)
-            changes_made = True
+    if added_proxies:
+        http_config["trusted_proxies"].extend(added_proxies)
+        changes_made = True
+        for proxy in added_proxies:
             logger.info(f"Added trusted proxy: {proxy}")
 
     if changes_made:
@@ -216,7 +442,10 @@ def ensure_http_config(config_path: str = HA_CONFIG_PATH) -> bool:
         backup_path = _backup_config(config_path)
 
         try:
-            _save_config(config_path, config)
+            if not needs_dump and _append_trusted_proxies(config_path, added_proxies):
+                logger.info("Appended trusted proxies in place (formatting preserved)")
+            else:
+                _save_config(config_path, config)
             logger.info("configuration.yaml updated. Validating...")
         except Exception as e:
             logger.error(f"Failed to write configuration.yaml: {e}")
@@ -12,18 +12,88 @@ import asyncio
 import logging
 import signal
 import sys
-from typing import Dict, Optional
+from typing import Dict, Optional, Union
 
 import aiohttp
 import msgpack
 import websockets
 import websockets.client
 
+# orjson is optional; fall back to the stdlib parser
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 logger = logging.getLogger("dimensiondoor")
 
 
 MAX_CONSECUTIVE_FAILURES = 5
 
+# Servers advertising this feature in the welcome message accept large
+# responses as http_response_start / http_response_chunk / http_response_end
+FEATURE_HTTP_STREAM = "http_response_stream"
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Bodies up to this size with a known Content-Length are read in one exact read
+SMALL_BODY_SIZE = 8 * 1024
+
+# Servers advertising this feature accept ws_data_batch messages carrying
+# several HA WebSocket frames ({"data", "is_text"}) at once
+FEATURE_WS_BATCH = "ws_data_batch"
+WS_BATCH_WINDOW = 0.002  # seconds
+WS_BATCH_MAX_FRAMES = 64
+WS_BATCH_QUEUE_SIZE = 256
+
+# Compact positional message encoding: (type_tag, *fields) arrays instead of
+# string-keyed maps. Accepted from any server; http_response is only sent
+# compact to servers advertising FEATURE_COMPACT_MESSAGES.
+FEATURE_COMPACT_MESSAGES = "compact_messages"
+MSG_HTTP_REQ = 1
+MSG_HTTP_RESP = 2
+MSG_WS_OPEN = 3
+MSG_WS_DATA = 4
+MSG_WS_CLOSE = 5
+
+# Field order of compact inbound messages, after the type tag
+_COMPACT_INBOUND = {
+    MSG_HTTP_REQ: ("http_request", ("request_id", "method", "path", "query_string", "headers", "body")),
+    MSG_WS_OPEN: ("ws_open", ("ws_id", "path", "query_string")),
+    MSG_WS_DATA: ("ws_data", ("ws_id", "data", "is_text")),
+    MSG_WS_CLOSE: ("ws_close", ("ws_id",)),
+}
+
+# Cheap, non-blocking handlers run inline on the read loop; the rest get
+# their own task so a slow HA round-trip can't stall the tunnel (ws_close only
+# drops the connection inline and closes it in the background)
+_INLINE_MESSAGE_TYPES = frozenset({"ws_data", "ws_close"})
+
+# Request headers that shouldn't be forwarded to HA (compared lowercase)
+# - Proxy headers (X-Forwarded-*): triggers 400 if HA doesn't trust us
+# - Accept-Encoding: aiohttp auto-decompresses, so we must not tell HA
+#   to compress (otherwise Content-Encoding header won't match the body)
+_SKIP_REQ_HEADERS = frozenset({
+    "host", "connection", "upgrade", "transfer-encoding", "content-length",
+    "x-forwarded-for", "x-forwarded-proto", "x-forwarded-host",
+    "x-real-ip", "x-forwarded-server",
+    "accept-encoding",
+})
+
+# Hop-by-hop headers and Content-Encoding stripped from HA responses (compared lowercase)
+# (aiohttp auto-decompresses, so the body is already plain text
+#  but the header would still say gzip - causing browser issues)
+_DROP_RESP_HEADERS = frozenset({
+    "transfer-encoding", "connection", "keep-alive",
+    "content-length", "content-encoding",
+})
+
+
+def _filter_headers(headers, skip: frozenset) -> dict:
+    """Copy headers, dropping any whose lowercased name is in skip."""
+    # A frozenset lookup beats a generated chain of == comparisons here:
+    # with ~10 names, the chain is slower for every header that isn't skipped
+    return {k: v for k, v in headers.items() if k.lower() not in skip}
+
 
 class TunnelClient:
     def __init__(self, token: str, server_url: str, ha_url: str):
@@ -31,16 +101,39 @@ class TunnelClient:
         self.server_url = server_url
         self.ha_url = ha_url.rstrip("/")
         self._ws: Optional[websockets.client.WebSocketClientProtocol] = None
+        self._ws_alive = False  # cheaper than checking self._ws.closed on every send
         self._http_session: Optional[aiohttp.ClientSession] = None
         self._ws_connections: Dict[str, aiohttp.ClientWebSocketResponse] = {}
         self._running = True
         self._reconnect_delay = 1  # seconds, with exponential backoff
         self._consecutive_failures = 0
+        # Reused for every outbound frame; safe since all sends happen on the event loop.
+        # With autoreset the Packer already keeps its internal buffer between calls,
+        # so the returned bytes is the only per-message allocation (websockets needs
+        # an owned copy anyway); autoreset=False + bytes() + reset() measured slower.
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self._server_features: frozenset = frozenset()
+        self._handlers = {
+            "http_request": self._handle_http_request,
+            "ws_open": self._handle_ws_open,
+            "ws_data": self._handle_ws_data,
+            "ws_close": self._handle_ws_close,
+        }
 
     async def start(self):
         """Main entry point - connects and handles reconnection."""
+        # Every request goes to the same HA host, and each proxied WebSocket or
+        # streamed response holds its connection for its whole lifetime, so don't
+        # cap the pool at all (aiohttp defaults to 100). Also keep a long DNS cache
+        # (homeassistant resolves via Docker DNS).
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            use_dns_cache=True,
+            ttl_dns_cache=300,
+        )
         self._http_session = aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=60)
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=60),
         )
 
         while self._running:
@@ -100,16 +193,18 @@ class TunnelClient:
                 close_timeout=10,
             ) as ws:
                 self._ws = ws
+                self._ws_alive = True
+                self._server_features = frozenset()
 
                 # Read the welcome message
                 welcome = await ws.recv()
                 if isinstance(welcome, str):
-                    import json
-                    data = json.loads(welcome)
+                    data = _json_loads(welcome)
                     if data.get("error"):
                         logger.error(f"Server rejected connection: {data['error']}")
                         self._running = False
                         return
+                    self._server_features = frozenset(data.get("features") or ())
                     logger.info(f"Connected! URL: {data.get('url', 'unknown')}")
                     self._reconnect_delay = 1  # Reset backoff only after confirmed success
                     self._consecutive_failures = 0
@@ -125,6 +220,8 @@ class TunnelClient:
         except websockets.exceptions.InvalidStatusCode as e:
             logger.error(f"Server returned HTTP {e.status_code} - check tunnel server logs")
             raise
+        finally:
+            self._ws_alive = False
 
     async def _handle_message(self, data: bytes):
         """Handle an incoming message from the tunnel server."""
@@ -134,18 +231,27 @@ class TunnelClient:
             logger.error(f"Failed to unpack message: {e}")
             return
 
-        msg_type = msg.get("type", "")
-
-        if msg_type == "http_request":
-            asyncio.create_task(self._handle_http_request(msg))
-        elif msg_type == "ws_open":
-            asyncio.create_task(self._handle_ws_open(msg))
-        elif msg_type == "ws_data":
-            asyncio.create_task(self._handle_ws_data(msg))
-        elif msg_type == "ws_close":
-            asyncio.create_task(self._handle_ws_close(msg))
+        if isinstance(msg, (list, tuple)):
+            compact = _COMPACT_INBOUND.get(msg[0]) if msg else None
+            if compact is None:
+                logger.warning(f"Unknown compact message type: {msg[0] if msg else None}")
+                return
+            msg_type, fields = compact
+            msg = dict(zip(fields, msg[1:]))
         else:
+            msg_type = msg.get("type", "")
+
+        handler = self._handlers.get(msg_type)
+        if handler is None:
             logger.warning(f"Unknown message type: {msg_type}")
+        elif msg_type in _INLINE_MESSAGE_TYPES:
+            # Don't let a failure on one proxied WS tear down the whole tunnel
+            try:
+                await handler(msg)
+            except Exception as e:
+                logger.error(f"Failed to handle {msg_type}: {e}")
+        else:
+            asyncio.create_task(handler(msg))
 
     async def _handle_http_request(self, msg: dict):
         """Proxy an HTTP request to the local HA instance."""
@@ -160,20 +266,7 @@ class TunnelClient:
         if query_string:
             url = f"{url}?{query_string}"
 
-        # Remove headers that shouldn't be forwarded
-        # - Proxy headers (X-Forwarded-*): triggers 400 if HA doesn't trust us
-        # - Accept-Encoding: aiohttp auto-decompresses, so we must not tell HA
-        #   to compress (otherwise Content-Encoding header won't match the body)
-        forward_headers = {}
-        skip = {
-            "host", "connection", "upgrade", "transfer-encoding", "content-length",
-            "x-forwarded-for", "x-forwarded-proto", "x-forwarded-host",
-            "x-real-ip", "x-forwarded-server",
-            "accept-encoding",
-        }
-        for k, v in headers.items():
-            if k.lower() not in skip:
-                forward_headers[k] = v
+        forward_headers = _filter_headers(headers, _SKIP_REQ_HEADERS)
 
         logger.debug(f"Proxying {method} {url}")
 
@@ -186,10 +279,7 @@ class TunnelClient:
                 allow_redirects=False,
                 ssl=False,
             ) as resp:
-                resp_body = await resp.read()
-                resp_headers = dict(resp.headers)
-
-                logger.debug(f"HA responded: {resp.status} ({len(resp_body)} bytes) for {method} {path}")
+                resp_headers = _filter_headers(resp.headers, _DROP_RESP_HEADERS)
 
                 if resp.status == 400:
                     logger.warning(
@@ -198,12 +288,15 @@ class TunnelClient:
                         "http: {{ use_x_forwarded_for: true, trusted_proxies: [172.30.33.0/24] }}"
                     )
 
-                # Remove hop-by-hop headers and Content-Encoding
-                # (aiohttp auto-decompresses, so the body is already plain text
-                #  but the header would still say gzip - causing browser issues)
-                for h in ("Transfer-Encoding", "Connection", "Keep-Alive",
-                           "Content-Length", "Content-Encoding"):
-                    resp_headers.pop(h, None)
+                # Stream bodies that are large or of unknown size, if the server supports it
+                if FEATURE_HTTP_STREAM in self._server_features and (
+                    resp.content_length is None or resp.content_length > STREAM_CHUNK_SIZE
+                ):
+                    await self._stream_http_response(request_id, resp, resp_headers)
+                    return
+
+                resp_body = await self._read_body(resp)
+                logger.debug(f"HA responded: {resp.status} ({len(resp_body)} bytes) for {method} {path}")
 
                 response = {
                     "type": "http_response",
@@ -232,10 +325,76 @@ class TunnelClient:
                 "body": b"Internal tunnel error",
             }
 
+        if FEATURE_COMPACT_MESSAGES in self._server_features:
+            response = (
+                MSG_HTTP_RESP,
+                response["request_id"],
+                response["status"],
+                response["headers"],
+                response["body"],
+            )
+
         # Send response back through the tunnel
-        if self._ws and not self._ws.closed:
-            packed = msgpack.packb(response, use_bin_type=True)
-            await self._ws.send(packed)
+        await self._send(response)
+
+    async def _read_body(self, resp: aiohttp.ClientResponse) -> bytes:
+        """Read a full HA response body, skipping aiohttp's grow-buffer for small known sizes."""
+        cl = resp.content_length
+        # Content-Length only matches the decoded body when HA didn't compress it
+        if cl is not None and cl <= SMALL_BODY_SIZE and "Content-Encoding" not in resp.headers:
+            try:
+                return await resp.content.readexactly(cl)
+            except asyncio.IncompleteReadError as e:
+                # Keep what was read and collect the rest the slow way
+                return e.partial + await resp.read()
+        return await resp.read()
+
+    async def _stream_http_response(self, request_id: str, resp: aiohttp.ClientResponse,
+                                    resp_headers: dict):
+        """Relay an HA response body to the tunnel in chunks instead of buffering it."""
+        if not await self._send({
+            "type": "http_response_start",
+            "request_id": request_id,
+            "status": resp.status,
+            "headers": resp_headers,
+        }):
+            return
+
+        total = 0
+        error = None
+        try:
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                total += len(chunk)
+                if not await self._send({
+                    "type": "http_response_chunk",
+                    "request_id": request_id,
+                    "data": chunk,
+                }):
+                    return
+        except Exception as e:
+            # Headers are already sent, so the server can only abort the response
+            logger.error(f"HA response stream failed after {total} bytes: {e}")
+            error = str(e)
+
+        end = {"type": "http_response_end", "request_id": request_id}
+        if error:
+            end["error"] = error
+        await self._send(end)
+        logger.debug(f"HA responded: {resp.status} ({total} bytes, streamed) for request {request_id}")
+
+    async def _send(self, msg: Union[dict, tuple]) -> bool:
+        """Pack and send a message to the tunnel server. Returns False if not connected."""
+        if not self._ws_alive:
+            return False
+        ws = self._ws
+        try:
+            await ws.send(self._packer.pack(msg))
+        except websockets.exceptions.ConnectionClosed:
+            # Only mark dead if we haven't reconnected in the meantime
+            if ws is self._ws:
+                self._ws_alive = False
+            return False
+        return True
 
     async def _handle_ws_open(self, msg: dict):
         """Open a WebSocket connection to HA for proxying browser WebSocket."""
@@ -260,49 +419,94 @@ class TunnelClient:
         except Exception as e:
             logger.error(f"Failed to open WS to HA: {e}")
             # Send close to server
-            if self._ws and not self._ws.closed:
-                close_msg = msgpack.packb({
-                    "type": "ws_close",
-                    "ws_id": ws_id,
-                }, use_bin_type=True)
-                await self._ws.send(close_msg)
+            await self._send({"type": "ws_close", "ws_id": ws_id})
 
     async def _relay_ws_from_ha(self, ws_id: str, ws_conn: aiohttp.ClientWebSocketResponse):
         """Read from HA WebSocket and forward to tunnel server."""
+        queue: Optional[asyncio.Queue] = None
+        flusher: Optional[asyncio.Task] = None
+        if FEATURE_WS_BATCH in self._server_features:
+            queue = asyncio.Queue(maxsize=WS_BATCH_QUEUE_SIZE)
+            flusher = asyncio.create_task(self._flush_ws_batches(ws_id, queue))
+
         try:
             async for msg in ws_conn:
                 if msg.type == aiohttp.WSMsgType.TEXT:
-                    relay = msgpack.packb({
-                        "type": "ws_data",
-                        "ws_id": ws_id,
+                    frame = {
                         "data": msg.data.encode() if isinstance(msg.data, str) else msg.data,
                         "is_text": True,
-                    }, use_bin_type=True)
-                    if self._ws and not self._ws.closed:
-                        await self._ws.send(relay)
-
+                    }
                 elif msg.type == aiohttp.WSMsgType.BINARY:
-                    relay = msgpack.packb({
-                        "type": "ws_data",
-                        "ws_id": ws_id,
+                    frame = {
                         "data": msg.data,
                         "is_text": False,
-                    }, use_bin_type=True)
-                    if self._ws and not self._ws.closed:
-                        await self._ws.send(relay)
-
+                    }
                 elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.ERROR):
                     break
+                else:
+                    continue
+
+                if flusher is None:
+                    await self._send({"type": "ws_data", "ws_id": ws_id, **frame})
+                elif flusher.done():
+                    break
+                else:
+                    await queue.put(frame)
         except Exception as e:
             logger.error(f"WS relay error for {ws_id}: {e}")
         finally:
             self._ws_connections.pop(ws_id, None)
-            if self._ws and not self._ws.closed:
-                close_msg = msgpack.packb({
-                    "type": "ws_close",
-                    "ws_id": ws_id,
-                }, use_bin_type=True)
-                await self._ws.send(close_msg)
+            # Flush whatever is still queued before telling the server we're closed
+            if flusher is not None and not flusher.done():
+                await queue.put(None)
+                await flusher
+            await self._send({"type": "ws_close", "ws_id": ws_id})
+
+    async def _flush_ws_batches(self, ws_id: str, queue: asyncio.Queue):
+        """
+        Coalesce HA frames that arrive within WS_BATCH_WINDOW of each other
+        into a single ws_data_batch message. A None in the queue ends the flusher.
+
+        Keeps draining (and discarding) after a failed send until it sees the
+        None, so the relay can never block forever on a full queue.
+        """
+        loop = asyncio.get_running_loop()
+        sending = True
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                return
+            frames = [frame]
+            finished = False
+            deadline = loop.time() + WS_BATCH_WINDOW
+
+            while len(frames) < WS_BATCH_MAX_FRAMES:
+                try:
+                    frame = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        frame = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if frame is None:
+                    finished = True
+                    break
+                frames.append(frame)
+
+            if sending:
+                try:
+                    if len(frames) == 1:
+                        sending = await self._send({"type": "ws_data", "ws_id": ws_id, **frames[0]})
+                    else:
+                        sending = await self._send({"type": "ws_data_batch", "ws_id": ws_id, "frames": frames})
+                except Exception as e:
+                    logger.error(f"WS batch flush error for {ws_id}: {e}")
+                    sending = False
+            if finished:
+                return
 
     async def _handle_ws_data(self, msg: dict):
         """Forward WebSocket data from browser to HA."""
@@ -328,7 +532,9 @@ class TunnelClient:
         ws_id = msg.get("ws_id", "")
         ws_conn = self._ws_connections.pop(ws_id, None)
         if ws_conn and not ws_conn.closed:
-            await ws_conn.close()
+            # close() waits for HA's close frame (up to aiohttp's close timeout),
+            # so don't hold up the tunnel read loop on it
+            asyncio.create_task(ws_conn.close())
 
     async def _cleanup(self):
         """Clean up all connections."""